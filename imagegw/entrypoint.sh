@@ -11,7 +11,16 @@ fi
 for service in $@ ; do
   echo "service: $service"
   if [ "$service"  == "api" ] ; then
-    gunicorn -b 0.0.0.0:5000 --backlog 2048 shifter_imagegw.api:app
+    if [ -n "$GW_GEVENT" ] ; then
+      gunicorn -b 0.0.0.0:5000 --backlog 2048 \
+          -k gevent --worker-connections ${GW_CONNECTIONS:-200} \
+          --workers ${GW_WORKERS:-4} \
+          shifter_imagegw.api:app
+    else
+      gunicorn -b 0.0.0.0:5000 --backlog 2048 \
+          --workers ${GW_WORKERS:-$(nproc)} --threads ${GW_THREADS:-8} \
+          shifter_imagegw.api:app
+    fi
   elif  [ $(echo $service|grep -c "worker:") -gt 0 ] ; then
     queue=$(echo $service|sed 's/.*://')
     echo "Worker Queue: $queue"
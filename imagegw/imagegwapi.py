@@ -20,6 +20,16 @@ modification, are permitted provided that the following conditions are met:
 See LICENSE for full text.
 """
 
+import os
+
+# Patch the standard library for gevent before anything else imports it.
+# gunicorn's gevent worker (-k gevent) does this on its own.
+if os.environ.get('GW_GEVENT'):
+    from gevent import monkey
+    monkey.patch_all()
+
+# This starts the Flask development server and is only intended for
+# debugging.  Use gunicorn (see README.md) for production.
 from shifter_imagegw import api
 
 LISTEN_PORT = 5000
@@ -26,11 +26,13 @@ import os
 import sys
 import logging
 import shifter_imagegw
-from shifter_imagegw.imagemngr import ImageMngr
-from flask import Flask, request, jsonify
+from shifter_imagegw.imagemngr import ImageMngr, RESP_FIELDS
+from flask import Flask, Response, request, jsonify, stream_with_context
 
 
 app = Flask(__name__)
+# Responses are read by programs, so skip the indentation jsonify adds
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 config = {}
 AUTH_HEADER = 'authentication'
 
@@ -44,7 +46,7 @@ app.logger.setLevel(logging.INFO)
 app.debug_log_format = '%(asctime)s [%(name)s] %(levelname)s : %(message)s'
 app.logger.debug('Initializing image manager')
 
-app.logger.info("initializing with %s" % (CONFIG_FILE))
+app.logger.info("initializing with %s", CONFIG_FILE)
 with open(CONFIG_FILE) as config_file:
     config = json.load(config_file)
     if 'LogLevel' in config:
@@ -62,6 +64,8 @@ with open(CONFIG_FILE) as config_file:
         else:
             app.logger.critical('Unrecongnized Log Level specified')
 mgr = ImageMngr(config, logger=app.logger)
+# Reconcile task states in the background instead of on each request
+mgr.start_state_updates()
 
 # For RESTful Service
 @app.errorhandler(404)
@@ -82,19 +86,22 @@ def apihelp():
     """ API helper return """
     return "{lookup,pull,expire,list}"
 
-def create_response(rec):
-    """ Helper function to create a formated JSON response. """
-    resp = {}
-    fields = (
-        'id', 'system', 'itype', 'tag', 'status', 'userAcl', 'groupAcl',
-        'ENV', 'ENTRY', 'WORKDIR', 'last_pull', 'status_message',
-    )
-    for field in fields:
-        try:
-            resp[field] = rec[field]
-        except KeyError:
-            resp[field] = 'MISSING'
-    return resp
+def _make_create_response(fields):
+    """
+    Generate create_response as a single dict literal over fields so the
+    field list isn't walked in a loop for every record.  The field names
+    are constants from imagemngr, not user input.
+    """
+    items = ', '.join('%r: rec.get(%r, %r)' % (field, field, 'MISSING')
+                      for field in fields)
+    source = 'def create_response(rec):\n    return {%s}\n' % (items)
+    namespace = {}
+    exec(compile(source, '<create_response>', 'exec'), namespace)
+    func = namespace['create_response']
+    func.__doc__ = """ Helper function to create a formated JSON response. """
+    return func
+
+create_response = _make_create_response(RESP_FIELDS)
 
 # List images
 # This will list the images for a system
@@ -102,20 +109,25 @@ def create_response(rec):
 def imglist(system):
     """ List images for a specific system. """
     auth = request.headers.get(AUTH_HEADER)
-    app.logger.debug("list system=%s" % (system))
+    app.logger.debug("list system=%s", system)
     try:
         session = mgr.new_session(auth, system)
-        records = mgr.imglist(session, system)
-        if records is None:
-            return not_found('image not found')
+        records = mgr.imglist_iter(session, system)
+        # Pull the first record so query errors still return a 404
+        first = next(records, None)
     except:
         app.logger.exception('Exception in list')
         return not_found('%s' % (sys.exc_value))
-    images = []
-    for rec in records:
-        images.append(create_response(rec))
-    resp = {'list': images}
-    return jsonify(resp)
+
+    def generate():
+        """ Stream the list one record at a time. """
+        yield '{"list": ['
+        if first is not None:
+            yield json.dumps(create_response(first))
+            for rec in records:
+                yield ', ' + json.dumps(create_response(rec))
+        yield ']}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 
 # Lookup image
@@ -127,9 +139,8 @@ def lookup(system, imgtype, tag):
         tag = '%s:latest' % (tag)
 
     auth = request.headers.get(AUTH_HEADER)
-    memo = 'lookup system=%s imgtype=%s tag=%s auth=%s' \
-            % (system, imgtype, tag, auth)
-    app.logger.debug(memo)
+    app.logger.debug('lookup system=%s imgtype=%s tag=%s auth=%s',
+                     system, imgtype, tag, auth)
     i = {'system':system, 'itype':imgtype, 'tag':tag}
     try:
         session = mgr.new_session(auth, system)
@@ -150,8 +161,7 @@ def pull(system, imgtype, tag):
         tag = '%s:latest' % (tag)
 
     auth = request.headers.get(AUTH_HEADER)
-    memo = "pull system=%s imgtype=%s tag=%s" % (system, imgtype, tag)
-    app.logger.debug(memo)
+    app.logger.debug("pull system=%s imgtype=%s tag=%s", system, imgtype, tag)
     i = {'system':system, 'itype':imgtype, 'tag':tag}
     try:
         session = mgr.new_session(auth, system)
@@ -168,7 +178,7 @@ def pull(system, imgtype, tag):
 def autoexpire(system):
     """ Run the autoexpire handler to purge old images """
     auth = request.headers.get(AUTH_HEADER)
-    app.logger.debug("autoexpire system=%s" % (system))
+    app.logger.debug("autoexpire system=%s", system)
     try:
         session = mgr.new_session(auth, system)
         resp = mgr.autoexpire(session, system)
@@ -187,8 +197,7 @@ def expire(system, imgtype, tag):
 
     auth = request.headers.get(AUTH_HEADER)
     i = {'system':system, 'itype':imgtype, 'tag':tag}
-    memo = "expire system=%s imgtype=%s tag=%s" % (system, imgtype, tag)
-    app.logger.debug(memo)
+    app.logger.debug("expire system=%s imgtype=%s tag=%s", system, imgtype, tag)
     resp = None
     try:
         session = mgr.new_session(auth, system)
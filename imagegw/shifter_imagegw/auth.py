@@ -22,6 +22,7 @@ Module to abstract authentication.  Currently just wraps munge.
 """
 
 import json
+import logging
 from shifter_imagegw import munge
 
 class Authentication(object):
@@ -44,6 +45,14 @@ class Authentication(object):
                 self.sockets[system] = \
                         config['Platforms'][system]['mungeSocketPath']
             self.type = 'munge'
+            # Decode in process with libmunge instead of forking unmunge
+            # for every request, if enabled and available.
+            self.unmunge = munge.unmunge
+            if config.get('MungeLibrary', False):
+                if munge.LIBMUNGE is not None:
+                    self.unmunge = munge.unmunge_lib
+                else:
+                    logging.warn('libmunge not found, using unmunge')
         elif config['Authentication'] == "mock":
             self.type = 'mock'
         else:
@@ -58,7 +67,7 @@ class Authentication(object):
             raise KeyError("No Auth String Provided")
         if system is None:
             raise KeyError('System must be specified for munge')
-        response = munge.unmunge(authstr, socket=self.sockets[system])
+        response = self.unmunge(authstr, socket=self.sockets[system])
         if response is None:
             raise OSError('Authentication Failed')
         ret = dict()
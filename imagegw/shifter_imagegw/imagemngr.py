@@ -25,16 +25,62 @@ and dispatches work through Celery.
 """
 
 import json
+import hashlib
 import sys
 import os
 import logging
+import threading
 from time import time, sleep
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from celery.utils import uuid
+import pymongo
 import pymongo.errors
 from shifter_imagegw.auth import Authentication
 from shifter_imagegw.imageworker import dopull, initqueue, doexpire
 import bson
-import celery
+
+# Fields returned to the API layer.  Queries that only feed responses
+# use this as a projection so mongo doesn't send the whole document.
+# last_heartbeat is not returned but is needed to decide if an image is
+# pullable.
+RESP_FIELDS = (
+    'id', 'system', 'itype', 'tag', 'status', 'userAcl', 'groupAcl',
+    'ENV', 'ENTRY', 'WORKDIR', 'last_pull', 'status_message',
+)
+RESP_PROJECTION = dict.fromkeys(RESP_FIELDS + ('last_heartbeat',), 1)
+# Fields that track the celery task working on an image
+TASK_FIELDS = {'task_id': '', 'task_type': ''}
+
+# Connection pool settings for mongo.  These can be overridden with the
+# MongoDBOptions setting in the configuration.
+MONGO_OPTIONS = {
+    'maxPoolSize': 200,
+    'minPoolSize': 10,
+    'socketTimeoutMS': 5000,
+    'serverSelectionTimeoutMS': 2000,
+    'retryWrites': True,
+    'appname': 'shifter-imagegw',
+}
+# Mongo clients keyed on URI and options so all image managers (and
+# threads) in a process with the same settings share one connection pool
+MONGO_CLIENTS = dict()
+MONGO_CLIENTS_LOCK = threading.Lock()
+
+
+def get_mongo_client(uri, options=None):
+    """
+    Return the shared MongoClient for uri and options, creating it on first
+    use.  options are passed to MongoClient in addition to MONGO_OPTIONS.
+    """
+    kwargs = MONGO_OPTIONS.copy()
+    if options is not None:
+        kwargs.update(options)
+    # Options come from the JSON config and may not be hashable
+    key = (uri, json.dumps(kwargs, sort_keys=True))
+    with MONGO_CLIENTS_LOCK:
+        if key not in MONGO_CLIENTS:
+            MONGO_CLIENTS[key] = MongoClient(uri, **kwargs)
+        return MONGO_CLIENTS[key]
 
 ## decorator function to re-attempt any mongo operation that may have failed
 ## owing to AutoReconnect (e.g., mongod coming back, etc).  This may increase
@@ -67,28 +113,50 @@ class ImageMngr(object):
         """
         if logger is None:
             self.logger = logging.getLogger(logname)
-            log_handler = logging.StreamHandler()
-            logfmt = '%(asctime)s [%(name)s] %(levelname)s : %(message)s'
-            log_handler.setFormatter(logging.Formatter(logfmt))
-            log_handler.setLevel(logging.DEBUG)
-            self.logger.addHandler(log_handler)
+            # Only add the handler once if several managers share the logger
+            if not self.logger.handlers:
+                log_handler = logging.StreamHandler()
+                logfmt = '%(asctime)s [%(name)s] %(levelname)s : %(message)s'
+                log_handler.setFormatter(logging.Formatter(logfmt))
+                log_handler.setLevel(logging.DEBUG)
+                self.logger.addHandler(log_handler)
+            # Don't also pass messages up to the root logger's handlers
+            self.logger.propagate = False
         else:
             self.logger = logger
 
         self.logger.debug('Initializing image manager')
+        if not bson.has_c():
+            self.logger.warn('bson C extension not available, '
+                             'mongo queries will be slower')
         self.config = config
         if 'Platforms' not in self.config:
             raise NameError('Platforms not defined')
         self.systems = []
-        self.tasks = []
-        self.expire_requests = dict()
-        self.task_image_id = dict()
         # Time before another pull can be attempted
         self.pullupdatetimeout = 300
         if 'PullUpdateTime' in self.config:
             self.pullupdatetimeout = self.config['PullUpdateTimeout']
         # Max amount of time to allow for a pull
         self.pulltimeout = self.pullupdatetimeout*10
+        # Cache of READY image records keyed on (system, itype, tag) so
+        # repeated lookups don't go back to mongo.  lookup_cache_refs maps
+        # a mongo id or a (system, tag) to the cache keys that refer to it
+        # so entries can be invalidated without scanning the cache.
+        self.lookup_cache = dict()
+        self.lookup_cache_refs = dict()
+        self.lookup_cache_size = 10000
+        self.lookup_cache_timeout = 30
+        if 'LookupCacheTimeout' in self.config:
+            self.lookup_cache_timeout = self.config['LookupCacheTimeout']
+        # Cache of authenticated sessions keyed on a digest of the auth
+        # string.  This is off by default since a cached munge credential
+        # will be accepted again without munge's replay detection.
+        self.session_cache = dict()
+        self.session_cache_size = 1024
+        self.session_cache_timeout = 0
+        if 'SessionCacheTimeout' in self.config:
+            self.session_cache_timeout = self.config['SessionCacheTimeout']
         # This is not intended to provide security, but just
         # provide a basic check that a session object is correct
         self.magic = 'imagemngrmagic'
@@ -101,14 +169,48 @@ class ImageMngr(object):
             self.systems.append(system)
         # Connect to database
         if 'MongoDBURI' in self.config:
-            client = MongoClient(self.config['MongoDBURI'])
+            client = get_mongo_client(self.config['MongoDBURI'],
+                                      self.config.get('MongoDBOptions'))
             db_ = self.config['MongoDB']
             self.images = client[db_].images
         else:
             raise NameError('MongoDBURI not defined')
+        self._create_indexes()
         initqueue(config)
+        # Task states can be reconciled in the background instead of on
+        # each request.  See start_state_updates.
+        self.update_lock = threading.Lock()
+        self.timer_lock = threading.Lock()
+        self.timer = None
+        self.state_update_interval = 1
+        if 'StateUpdateInterval' in self.config:
+            self.state_update_interval = self.config['StateUpdateInterval']
         # Initialize data structures
 
+    def _create_indexes(self):
+        """
+        Create the indexes used by the lookup and state queries if they
+        don't already exist.  The tag index can't be unique since pull
+        records share an empty tag list until the pull completes.  The
+        unique pull_lock index is what allows only one active pull record
+        per image.
+        """
+        indexes = (
+            ('system_1_itype_1_tag_1',
+             [('system', pymongo.ASCENDING), ('itype', pymongo.ASCENDING),
+              ('tag', pymongo.ASCENDING)], {}),
+            ('status_1', [('status', pymongo.ASCENDING)], {}),
+            ('task_id_1', [('task_id', pymongo.ASCENDING)], {'sparse': True}),
+            ('pull_lock_1', [('pull_lock', pymongo.ASCENDING)],
+             {'sparse': True, 'unique': True}),
+        )
+        existing = self.images.index_information()
+        for (name, keys, options) in indexes:
+            if name not in existing:
+                self.logger.info('Creating mongo index %s', name)
+                self.images.create_index(keys, name=name, background=True,
+                                         **options)
+
     def check_session(self, session, system=None):
         """Check if this is a valid session
         session is a session handle
@@ -146,7 +248,7 @@ class ImageMngr(object):
         """
         Checks if the user has read permissions to the image. (Not Implemented)
         """
-        self.logger.warn("unimplemented checkread called for %s for user %s"%(imageid, user))
+        self.logger.warn("unimplemented checkread called for %s for user %s", imageid, user)
         return True
 
     def _resetexpire(self, ident):
@@ -158,12 +260,81 @@ class ImageMngr(object):
         self._images_update({'_id': ident}, {'$set': {'expiration': expire}})
         return expire
 
+    def _cache_key(self, image):
+        """Helper function to generate the lookup cache key for an image."""
+        return (image['system'], image['itype'], image['tag'])
+
+    def _cache_get(self, image):
+        """
+        Return a copy of the cached READY record for an image or None if
+        the image isn't cached or the entry has timed out.
+        """
+        key = self._cache_key(image)
+        entry = self.lookup_cache.get(key)
+        if entry is None:
+            return None
+        (cachetime, rec) = entry
+        if time() > cachetime + self.lookup_cache_timeout:
+            self._cache_drop(key)
+            return None
+        return rec.copy()
+
+    def _cache_refs(self, key, rec):
+        """Helper function to list the references to a cache entry."""
+        return (rec['_id'], (key[0], key[2]))
+
+    def _cache_put(self, image, rec):
+        """Add a READY record to the lookup cache."""
+        if len(self.lookup_cache) >= self.lookup_cache_size:
+            self.lookup_cache.clear()
+            self.lookup_cache_refs.clear()
+        key = self._cache_key(image)
+        self._cache_drop(key)
+        self.lookup_cache[key] = (time(), rec.copy())
+        for ref in self._cache_refs(key, rec):
+            self.lookup_cache_refs.setdefault(ref, set()).add(key)
+
+    def _cache_drop(self, key):
+        """Helper function to remove one entry from the lookup cache."""
+        entry = self.lookup_cache.pop(key, None)
+        if entry is None:
+            return
+        for ref in self._cache_refs(key, entry[1]):
+            keys = self.lookup_cache_refs.get(ref)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    self.lookup_cache_refs.pop(ref, None)
+
+    def _cache_invalidate(self, ident=None, system=None, tag=None):
+        """
+        Drop cached records.  Entries can be matched by the mongo id
+        (ident) or by system and tag.
+        """
+        refs = []
+        if ident is not None:
+            refs.append(ident)
+        if system is not None:
+            refs.append((system, tag))
+        for ref in refs:
+            for key in list(self.lookup_cache_refs.get(ref, ())):
+                self._cache_drop(key)
+
     def new_session(self, auth_string, system):
         """
         Creates a session context that can be used for multiple transactions.
         auth is an auth string that will be passed to the authenication layer.
         Returns a context that can be used for subsequent operations.
         """
+        key = None
+        if self.session_cache_timeout > 0 and auth_string is not None:
+            key = (system, hashlib.sha256(auth_string).hexdigest())
+            entry = self.session_cache.get(key)
+            if entry is not None:
+                (cachetime, session) = entry
+                if time() <= cachetime + self.session_cache_timeout:
+                    return session.copy()
+                self.session_cache.pop(key, None)
         arec = self.auth.authenticate(auth_string, system)
         if arec is None and isinstance(arec, dict):
             raise OSError("Authenication returned None")
@@ -173,6 +344,10 @@ class ImageMngr(object):
             session = arec
             session['magic'] = self.magic
             session['system'] = system
+            if key is not None:
+                if len(self.session_cache) >= self.session_cache_size:
+                    self.session_cache.clear()
+                self.session_cache[key] = (time(), session.copy())
             return session
 
     def lookup(self, session, image):
@@ -182,16 +357,13 @@ class ImageMngr(object):
         """
         if not self.check_session(session, image['system']):
             raise OSError("Invalid Session")
-        query = {
-            'status': 'READY',
-            'system': image['system'],
-            'itype': image['itype'],
-            'tag': {'$in': [image['tag']]}
-        }
-        self.update_states()
-        rec = self._images_find_one(query)
+        rec = self._cache_get(image)
+        if rec is not None:
+            return rec
+        rec = self._find_ready(image)
         if rec is not None:
-            self._resetexpire(rec['_id'])
+            rec['expiration'] = self._resetexpire(rec['_id'])
+            self._cache_put(image, rec)
         # TODO: verify access
         return rec
 
@@ -201,27 +373,36 @@ class ImageMngr(object):
         list images for a system.
         Image is dictionary with system defined.
         """
+        return list(self.imglist_iter(session, system))
+
+    def imglist_iter(self, session, system):
+        """
+        Same as imglist but returns a cursor so records can be consumed
+        as they arrive instead of building the whole list.
+        """
         if not self.check_session(session, system):
             raise OSError("Invalid Session")
         query = {'status': 'READY', 'system': system}
-        self.update_states()
-        records = self._images_find(query)
-        resp = []
-        for record in records:
-            resp.append(record)
         # verify access
-        return resp
+        # Fetch the whole listing in one batch instead of the default 101
+        return self._images_find(query, RESP_PROJECTION, batch_size=1000)
 
-    def _isready(self, image):
-        """Helper function to determine if an image is READY."""
+    def _find_ready(self, image):
+        """Helper function to find the READY record for an image."""
         query = {
             'status': 'READY',
             'system': image['system'],
             'itype': image['itype'],
             'tag': {'$in': [image['tag']]}
         }
-        rec = self._images_find_one(query)
-        if rec is not None:
+        return self._images_find_one(query, RESP_PROJECTION)
+
+    def _isready(self, image):
+        """Helper function to determine if an image is READY."""
+        rec = self._cache_get(image)
+        if rec is None:
+            rec = self._find_ready(image)
+        if rec is not None and rec.get('status') == 'READY':
             return True
         return False
 
@@ -271,16 +452,19 @@ class ImageMngr(object):
         return False
 
 
-    def new_pull_record(self, image):
+    def _pull_lock(self, image):
+        """Helper function to generate the pull_lock value for a pull request."""
+        return '%s/%s/%s' % (image['system'], image['itype'], image['pulltag'])
+
+    def new_pull_record(self, image, current=None, task_id=None):
         """
-        Creates a new image in mongo.  If the pull already exist it removes it first.
+        Creates a new pull record in mongo and reserves the pull.  current is
+        the existing pull record that isn't READY (if any).  It is replaced
+        only if it hasn't changed since it was read.  The record is written
+        already ENQUEUED for the pull task task_id (generated if not given)
+        so it never looks pullable to another request.  Returns None if
+        another request already reserved the pull.
         """
-        # Clean out any existing records
-        for rec in self._images_find(image):
-            if rec['status'] == 'READY':
-                continue
-            else:
-                self._images_remove({'_id': rec['_id']})
         newimage = {
             'format': 'invalid',#<ext4|squashfs|vfs>
             'arch': 'amd64', #<amd64|...>
@@ -291,7 +475,7 @@ class ImageMngr(object):
             'replication': '1', #<integer, number of copies to deploy>
             'userAcl': [],
             'tag': [],
-            'status': 'INIT',
+            'status': 'ENQUEUED',
             'groupAcl': []
         }
         if 'DefaultImageFormat' in self.config:
@@ -300,9 +484,54 @@ class ImageMngr(object):
             if param is 'tag':
                 continue
             newimage[param] = image[param]
-        self._images_insert(newimage)
+        # Pull records hold a unique pull_lock until they become READY
+        newimage['pull_lock'] = self._pull_lock(image)
+        if task_id is None:
+            task_id = uuid()
+        newimage['task_id'] = task_id
+        newimage['task_type'] = 'pull'
+        newimage['last_pull'] = time()
+        if current is not None:
+            query = {'_id': current['_id'], 'status': current.get('status')}
+            if 'last_pull' in current:
+                query['last_pull'] = current['last_pull']
+            else:
+                query['last_pull'] = {'$exists': False}
+            try:
+                return self._images_find_one_and_replace(query, newimage, RESP_PROJECTION,
+                                                         return_document=ReturnDocument.AFTER)
+            except pymongo.errors.DuplicateKeyError:
+                # Another record (not current) holds the pull lock
+                return None
+        try:
+            self._images_insert(newimage)
+        except pymongo.errors.DuplicateKeyError:
+            return None
         return newimage
 
+    def _track_task(self, ident, task_type):
+        """
+        Helper function to record the celery task that will work on the image
+        with _id==ident.  The task id is generated here and saved in mongo
+        before the task is dispatched so any image manager process can update
+        the state.  Returns the task id.
+        """
+        task_id = uuid()
+        setline = {'task_id': task_id, 'task_type': task_type}
+        self._images_update({'_id': ident}, {'$set': setline})
+        return task_id
+
+    def _untrack_task(self, ident, state=None):
+        """
+        Helper function to drop the task for the image with _id==ident when
+        it couldn't be dispatched.  The status is set to state if given.
+        """
+        update = {'$unset': TASK_FIELDS}
+        if state is not None:
+            update['$set'] = self._state_setlist(state)
+        self._images_update({'_id': ident}, update)
+        self._cache_invalidate(ident=ident)
+
     def pull(self, session, image, testmode=0):
         """
         pull the image
@@ -324,16 +553,12 @@ class ImageMngr(object):
         #  return the record
         rec = None
         # find any pull record
-        self.update_states()
+        # Refresh only the tasks working on this image.  The background
+        # timer keeps everything else up to date.
+        self._update_task_states(dict(request, task_id={'$exists': True}))
         # let's lookup the active image
-        query = {
-            'status': 'READY',
-            'system': image['system'],
-            'itype': image['itype'],
-            'tag': {'$in':[image['tag']]}
-        }
-        rec = self._images_find_one(query)
-        for record in self._images_find(request):
+        rec = self._find_ready(image)
+        for record in self._images_find(request, RESP_PROJECTION):
             status = record['status']
             if status == 'READY' or status == 'SUCCESS':
                 continue
@@ -342,28 +567,40 @@ class ImageMngr(object):
 
 
         if self._pullable(rec):
-            rec = self.new_pull_record(request)
+            current = None
+            if rec is not None and rec.get('status') != 'READY':
+                current = rec
+            task_id = uuid()
+            newrec = self.new_pull_record(request, current, task_id)
+            if newrec is None:
+                # Someone else reserved the pull first, so return their record
+                self.logger.debug("pull already in progress s=%s t=%s",
+                                  request['system'], request['pulltag'])
+                lockrec = self._images_find_one({'pull_lock': self._pull_lock(request)},
+                                                RESP_PROJECTION)
+                if lockrec is not None:
+                    return lockrec
+                return rec
+            rec = newrec
             ident = rec['_id']
-            self.logger.debug("Setting state")
-            self.update_mongo_state(ident, 'ENQUEUED')
             request['tag'] = request['pulltag']
+            self._cache_invalidate(system=request['system'], tag=request['tag'])
             self.logger.debug("Calling do pull with queue=%s", request['system'])
-            pullreq = dopull.apply_async([request], queue=request['system'], \
-                    kwargs={'testmode':testmode})
-
-            memo = "pull request queued s=%s t=%s" \
-                    % (request['system'], request['tag'])
-            self.logger.info(memo)
+            try:
+                dopull.apply_async([request], queue=request['system'], \
+                        task_id=task_id, kwargs={'testmode':testmode})
+            except:
+                self._untrack_task(ident, 'FAILURE')
+                raise
 
-            self.update_mongo(ident, {'last_pull': time()})
-            self.task_image_id[pullreq] = ident
-            self.tasks.append(pullreq)
+            self.logger.info("pull request queued s=%s t=%s",
+                             request['system'], request['tag'])
 
         return rec
 
-    def update_mongo_state(self, ident, state, info=None):
+    def _state_setlist(self, state, info=None):
         """
-        Helper function to set the mongo state for an image with _id==ident to state=state.
+        Helper function to build the $set fields for a state update.
         """
         if state == 'SUCCESS':
             state = 'READY'
@@ -373,7 +610,15 @@ class ImageMngr(object):
                 set_list['last_heartbeat'] = info['heartbeat']
             if 'message' in info:
                 set_list['status_message'] = info['message']
+        return set_list
+
+    def update_mongo_state(self, ident, state, info=None):
+        """
+        Helper function to set the mongo state for an image with _id==ident to state=state.
+        """
+        set_list = self._state_setlist(state, info)
         self._images_update({'_id': ident}, {'$set': set_list})
+        self._cache_invalidate(ident=ident)
 
     def add_tag(self, ident, system, tag):
         """
@@ -383,13 +628,13 @@ class ImageMngr(object):
         # Remove the tag first
         self.remove_tag(system, tag)
         # see if tag isn't a list
-        rec = self._images_find_one({'_id': ident})
+        rec = self._images_find_one({'_id': ident}, {'tag': 1})
         if rec is not None and 'tag' in rec and not isinstance(rec['tag'], (list)):
-            memo = 'Fixing tag for non-list %s %s' % (ident, str(rec['tag']))
-            self.logger.info(memo)
+            self.logger.info('Fixing tag for non-list %s %s', ident, rec['tag'])
             curtag = rec['tag']
             self._images_update({'_id': ident}, {'$set':{'tag':[curtag]}})
         self._images_update({'_id': ident}, {'$addToSet': {'tag': tag}})
+        self._cache_invalidate(ident=ident)
         return True
 
     def remove_tag(self, system, tag):
@@ -398,6 +643,7 @@ class ImageMngr(object):
         """
         self._images_update({'system': system, 'tag': {'$in': [tag]}},
                             {'$pull': {'tag': tag}}, multi=True)
+        self._cache_invalidate(system=system, tag=tag)
         return True
 
     def complete_pull(self, ident, response):
@@ -405,13 +651,14 @@ class ImageMngr(object):
         Transition a completed pull request to an available image.
         """
 
-        self.logger.debug("Complete called for %s %s", ident, str(response))
+        self.logger.debug("Complete called for %s %s", ident, response)
         pullrec = self._images_find_one({'_id': ident})
         if pullrec is None:
-            self.logger.warn('Missing pull request (r=%s)', str(response))
+            self.logger.warn('Missing pull request (r=%s)', response)
             return
         #Check that this image ident doesn't already exist for this system
-        rec = self._images_find_one({'id': response['id'], 'system': pullrec['system']})
+        rec = self._images_find_one({'id': response['id'], 'system': pullrec['system']},
+                                    {'tag': 1})
         tag = pullrec['pulltag']
         if rec is not None:
             # So we already had this image.
@@ -449,11 +696,11 @@ class ImageMngr(object):
             setline['last_pull'] = resp['last_pull']
 
         self._images_update({'_id': ident}, {'$set': setline})
+        self._cache_invalidate(ident=ident)
 
     def get_state(self, ident):
         """
         Lookup the state of the image with _id==ident in Mongo.  Returns the state."""
-        self.update_states()
         rec = self._images_find_one({'_id': ident}, {'status': 1})
         if rec is None:
             return None
@@ -461,52 +708,137 @@ class ImageMngr(object):
             return None
         return rec['status']
 
+    def start_state_updates(self):
+        """
+        Start running update_states every StateUpdateInterval seconds
+        (default 1, 0 disables it) in a background timer.
+        """
+        with self.timer_lock:
+            if self.state_update_interval <= 0 or self.timer is not None:
+                return
+            self._schedule_state_update()
+
+    def stop_state_updates(self):
+        """Stop the background state updates."""
+        with self.timer_lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def _schedule_state_update(self):
+        """Arm a timer to run the periodic state update."""
+        self.timer = threading.Timer(self.state_update_interval,
+                                     self._periodic_state_update)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _periodic_state_update(self):
+        """Timer callback that updates the states and re-arms the timer."""
+        try:
+            self.update_states()
+        except:
+            self.logger.exception('Exception in periodic state update')
+        with self.timer_lock:
+            # Don't re-arm if the updates were stopped
+            if self.timer is not None:
+                self._schedule_state_update()
+
     def update_states(self):
         """
         Update the states of all active transactions.
         Cleanup failed transcations after a period
         """
-        #logger.debug("Update_states called")
-        i = 0
-        tasks = self.tasks
-
-        for req in tasks:
-            state = 'PENDING'
+        # Serialize updates between the timer and request threads
+        with self.update_lock:
+            self._update_states()
 
-            if isinstance(req, celery.result.AsyncResult):
-                state = req.state
-                info = req.info
-            elif isinstance(req, bson.objectid.ObjectId):
-                self.logger.debug("Non-Async")
+    def _update_states(self):
+        """Helper function that does the work for update_states."""
+        #logger.debug("Update_states called")
+        self._update_task_states({'task_id': {'$exists': True}})
 
-            if req in self.expire_requests and state == 'SUCCESS':
-                self.expire_requests.pop(req)
-                self.tasks.remove(req)
-                state = 'EXPIRED'
-            elif req in self.expire_requests and state == 'FAILURE':
-                self.logger.warn("Expire request failed for %s", req)
-                self.expire_requests.pop(req)
-                self.tasks.remove(req)
-                continue
-            elif state == "FAILURE":
-                self.logger.warn("Pull failed for %s", req)
-
-            self.update_mongo_state(self.task_image_id[req], state, info)
-            if state == "READY" or state == "SUCCESS":
-                self.logger.debug("Completing pull request %d", i)
-                response = req.get()
-                self.complete_pull(self.task_image_id[req], response)
-                self.logger.debug('meta=%s', str(response))
-                # Now save the response
-                self.tasks.remove(req)
-            i += 1
         # Look for failed pulls
-        for rec in self._images_find({'status': 'FAILURE'}):
+        for rec in self._images_find({'status': 'FAILURE'}, {'last_pull': 1}):
             nextpull = self.pullupdatetimeout + rec['last_pull']
             # It it has been a while then let's clean up
             if time() > nextpull:
                 self._images_remove({'_id': rec['_id']})
 
+    def _update_task_states(self, query):
+        """
+        Helper function to update the state of the tracked tasks for the
+        records matching query and complete any finished pulls.
+        """
+        ops = []
+        updated = []
+        completed = []
+        fields = {
+            'task_id': 1, 'task_type': 1, 'status': 1, 'status_message': 1,
+            'last_heartbeat': 1
+        }
+
+        for rec in self._images_find(query, fields):
+            ident = rec['_id']
+            is_expire = rec.get('task_type') == 'expire'
+            if is_expire:
+                req = doexpire.AsyncResult(rec['task_id'])
+            else:
+                req = dopull.AsyncResult(rec['task_id'])
+            state = req.state
+            info = req.info
+
+            if state == 'REVOKED':
+                self.logger.warn("Task revoked for %s", ident)
+                state = 'FAILURE'
+
+            # Tasks that reached a final state are no longer tracked
+            done = False
+            if is_expire and state == 'SUCCESS':
+                state = 'EXPIRED'
+                done = True
+            elif is_expire and state == 'FAILURE':
+                self.logger.warn("Expire request failed for %s", ident)
+                ops.append(UpdateOne({'_id': ident}, {'$unset': TASK_FIELDS}))
+                continue
+            elif state == "FAILURE":
+                self.logger.warn("Pull failed for %s", ident)
+                done = True
+
+            complete = state == "READY" or state == "SUCCESS"
+            set_list = self._state_setlist(state, info)
+            update = {'$set': set_list}
+            if done:
+                update['$unset'] = TASK_FIELDS
+            elif not complete and \
+                    all(rec.get(key) == value for (key, value) in set_list.items()):
+                # Skip the write if nothing changed since the last update
+                continue
+            ops.append(UpdateOne({'_id': ident}, update))
+            # Only READY records are in the lookup cache
+            if rec.get('status') == 'READY':
+                updated.append(ident)
+            if complete:
+                completed.append((ident, req))
+
+        if len(ops) > 0:
+            self._images_bulk_write(ops, ordered=False)
+            for ident in updated:
+                self._cache_invalidate(ident=ident)
+
+        for (ident, req) in completed:
+            # Claim the pull so only one image manager process completes it
+            # READY records no longer hold the pull lock
+            unset = dict(TASK_FIELDS, pull_lock='')
+            claim = self._images_find_one_and_update({'_id': ident, 'task_id': req.id},
+                                                     {'$unset': unset},
+                                                     {'_id': 1})
+            if claim is None:
+                continue
+            self.logger.debug("Completing pull request %s", ident)
+            response = req.get()
+            self.complete_pull(ident, response)
+            self.logger.debug('meta=%s', response)
+
     def autoexpire(self, session, system, testmode=0):
         """Auto expire images and do cleanup"""
         # While this should be safe, let's restrict this to admins
@@ -519,7 +851,7 @@ class ImageMngr(object):
         for rec in self._images_find({'status': {'$ne': 'READY'}, 'system': system}):
             self.logger.debug(rec)
             if 'last_pull' not in rec:
-                self.logger.warning('Image missing last_pull for pulltag:' + rec['pulltag'])
+                self.logger.warning('Image missing last_pull for pulltag: %s', rec['pulltag'])
                 continue
             if rec['last_pull'] < pulltimeout:
                 removed.append(rec['_id'])
@@ -539,20 +871,21 @@ class ImageMngr(object):
                     expired.append(rec['id'])
                 else:
                     expired.append('unknown')
-            self.logger.debug(rec['expiration'] > time())
         return expired
 
 
     def expire_id(self, rec, ident, testmode=0):
         """ Helper function to expire by id """
-        memo = "Calling do expire with queue=%s id=%s TM=%d" % (rec['system'], ident, testmode)
-        self.logger.debug(memo)
-
-        req = doexpire.apply_async([rec], queue=rec['system'])
+        self.logger.debug("Calling do expire with queue=%s id=%s TM=%d",
+                          rec['system'], ident, testmode)
+
+        task_id = self._track_task(ident, 'expire')
+        try:
+            doexpire.apply_async([rec], queue=rec['system'], task_id=task_id)
+        except:
+            self._untrack_task(ident)
+            raise
         self.logger.info("expire request queued s=%s t=%s", rec['system'], ident)
-        self.task_image_id[req] = ident
-        self.expire_requests[req] = ident
-        self.tasks.append(req)
 
 
     def expire(self, session, image, testmode=0):
@@ -568,20 +901,20 @@ class ImageMngr(object):
         if rec is None:
             return None
         ident = rec.pop('_id')
-        memo = "Calling do expire with queue=%s id=%s TM=%d" \
-                % (image['system'], ident, testmode)
-        self.logger.debug(memo)
-
-        req = doexpire.apply_async([rec], queue=image['system'], \
-                kwargs={'testmode':testmode})
+        self._cache_invalidate(ident=ident)
+        self.logger.debug("Calling do expire with queue=%s id=%s TM=%d",
+                          image['system'], ident, testmode)
 
-        memo = "expire request queued s=%s t=%s" \
-                % (image['system'], image['tag'])
-        self.logger.info(memo)
+        task_id = self._track_task(ident, 'expire')
+        try:
+            doexpire.apply_async([rec], queue=image['system'], \
+                    task_id=task_id, kwargs={'testmode':testmode})
+        except:
+            self._untrack_task(ident)
+            raise
 
-        self.task_image_id[req] = ident
-        self.expire_requests[req] = ident
-        self.tasks.append(req)
+        self.logger.info("expire request queued s=%s t=%s",
+                         image['system'], image['tag'])
 
         return True
 
@@ -595,6 +928,11 @@ class ImageMngr(object):
         """ Decorated function to updates images in mongo """
         return self.images.update(*args, **kwargs)
 
+    @mongo_reconnect_reattempt
+    def _images_bulk_write(self, *args, **kwargs):
+        """ Decorated function to apply a batch of writes to images in mongo """
+        return self.images.bulk_write(*args, **kwargs)
+
     @mongo_reconnect_reattempt
     def _images_find(self, *args, **kwargs):
         """ Decorated function to find images in mongo """
@@ -605,6 +943,16 @@ class ImageMngr(object):
         """ Decorated function to find one image in mongo """
         return self.images.find_one(*args, **kwargs)
 
+    @mongo_reconnect_reattempt
+    def _images_find_one_and_replace(self, *args, **kwargs):
+        """ Decorated function to atomically replace an image in mongo """
+        return self.images.find_one_and_replace(*args, **kwargs)
+
+    @mongo_reconnect_reattempt
+    def _images_find_one_and_update(self, *args, **kwargs):
+        """ Decorated function to atomically update an image in mongo """
+        return self.images.find_one_and_update(*args, **kwargs)
+
     @mongo_reconnect_reattempt
     def _images_insert(self, *args, **kwargs):
         """ Decorated function to insert an image in mongo """
@@ -54,12 +54,30 @@ if 'ExpandDirectory' in CONFIG:
         os.mkdir(CONFIG['ExpandDirectory'])
 
 
-# Create Celery Queue and configure serializer
-#
-QUEUE = Celery('tasks', backend=CONFIG['Broker'], broker=CONFIG['Broker'])
-QUEUE.conf.update(CELERY_ACCEPT_CONTENT=['json'])
-QUEUE.conf.update(CELERY_TASK_SERIALIZER='json')
-QUEUE.conf.update(CELERY_RESULT_SERIALIZER='json')
+def _create_queue(config):
+    """
+    Create the Celery Queue and configure the serializer and prefetch
+    """
+    queue = Celery('tasks', backend=config['Broker'], broker=config['Broker'])
+    queue.conf.update(CELERY_ACCEPT_CONTENT=['json'])
+    queue.conf.update(CELERY_TASK_SERIALIZER='json')
+    queue.conf.update(CELERY_RESULT_SERIALIZER='json')
+    # Pulls are long running, so only hand a task to a worker process when
+    # it is free instead of letting a busy worker reserve queued pulls.
+    queue.conf.update(CELERYD_PREFETCH_MULTIPLIER=1)
+    queue.conf.update(CELERY_ACKS_LATE=True)
+    # A redis broker redelivers tasks that aren't acked within the
+    # visibility timeout (default 1 hour).  Keep it well above the time a
+    # pull is allowed to run (10x PullUpdateTimeout, as in the image
+    # manager) so a long pull isn't started again on another worker.
+    pulltimeout = config.get('PullUpdateTimeout', 300) * 10
+    queue.conf.update(BROKER_TRANSPORT_OPTIONS={
+        'visibility_timeout': pulltimeout * 2
+    })
+    queue.conf.update(CELERYD_MAX_TASKS_PER_CHILD=50)
+    return queue
+
+QUEUE = _create_queue(CONFIG)
 
 class Updater(object):
     """
@@ -84,10 +102,7 @@ def initqueue(newconfig):
     """
     global CONFIG, QUEUE
     CONFIG = newconfig
-    QUEUE = Celery('tasks', backend=CONFIG['Broker'], broker=CONFIG['Broker'])
-    QUEUE.conf.update(CELERY_ACCEPT_CONTENT=['json'])
-    QUEUE.conf.update(CELERY_TASK_SERIALIZER='json')
-    QUEUE.conf.update(CELERY_RESULT_SERIALIZER='json')
+    QUEUE = _create_queue(CONFIG)
 
 
 
@@ -22,8 +22,46 @@ Helper routines for munge
 """
 
 import sys
+import pwd
+import grp
+import ctypes
+import ctypes.util
 from subprocess import Popen, PIPE
 
+# munge_opt_t and munge_err_t values from munge.h
+MUNGE_OPT_SOCKET = 8
+EMUNGE_SUCCESS = 0
+EMUNGE_CRED_EXPIRED = 15
+EMUNGE_CRED_REPLAYED = 17
+
+def _load_libmunge():
+    """
+    Load libmunge so credentials can be decoded without running unmunge.
+    Returns None if the library isn't available.
+    """
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library('munge') or 'libmunge.so.2')
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    except OSError:
+        return None
+    lib.munge_ctx_create.restype = ctypes.c_void_p
+    lib.munge_ctx_destroy.argtypes = [ctypes.c_void_p]
+    lib.munge_ctx_destroy.restype = None
+    lib.munge_decode.argtypes = [
+        ctypes.c_char_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p),
+        ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_uint),
+        ctypes.POINTER(ctypes.c_uint)
+    ]
+    lib.munge_decode.restype = ctypes.c_int
+    lib.munge_strerror.argtypes = [ctypes.c_int]
+    lib.munge_strerror.restype = ctypes.c_char_p
+    libc.free.argtypes = [ctypes.c_void_p]
+    libc.free.restype = None
+    lib.libc_free = libc.free
+    return lib
+
+LIBMUNGE = _load_libmunge()
+
 
 def munge(text, socket=None):
     """
@@ -86,6 +124,66 @@ def unmunge(encoded, socket=None):
         raise
 
 
+def _idname(ident, lookup):
+    """
+    Format a uid or gid the way unmunge does, e.g. "root (0)"
+    """
+    try:
+        name = lookup(ident)[0]
+    except KeyError:
+        name = '?'
+    return '%s (%d)' % (name, ident)
+
+
+def unmunge_lib(encoded, socket=None):
+    """
+    Unmunge an encoded string using libmunge instead of forking unmunge.
+    Takes the same arguments and returns the same dictionary as unmunge.
+    raises exceptions if it fails.
+    """
+    if LIBMUNGE is None:
+        raise OSError('libmunge not available')
+    ctx = LIBMUNGE.munge_ctx_create()
+    if not ctx:
+        raise OSError('Unable to create munge context')
+    buf = ctypes.c_void_p()
+    length = ctypes.c_int()
+    uid = ctypes.c_uint()
+    gid = ctypes.c_uint()
+    try:
+        if socket is not None:
+            ret = LIBMUNGE.munge_ctx_set(ctypes.c_void_p(ctx), MUNGE_OPT_SOCKET,
+                                         ctypes.c_char_p(socket))
+            if ret != EMUNGE_SUCCESS:
+                raise OSError('Unable to set munge socket %s' % socket)
+        ret = LIBMUNGE.munge_decode(str(encoded).strip(), ctx, ctypes.byref(buf),
+                                    ctypes.byref(length), ctypes.byref(uid),
+                                    ctypes.byref(gid))
+        if ret == EMUNGE_CRED_EXPIRED:
+            raise OSError("Expired Credential")
+        elif ret == EMUNGE_CRED_REPLAYED:
+            raise OSError("Replayed Credential")
+        elif ret != EMUNGE_SUCCESS:
+            memo = "Unknown munge error %d %s: %s" \
+                    % (ret, socket, LIBMUNGE.munge_strerror(ret))
+            raise OSError(memo)
+        message = ''
+        if buf.value:
+            message = ctypes.string_at(buf.value, length.value)
+    finally:
+        if buf.value:
+            LIBMUNGE.libc_free(buf)
+        LIBMUNGE.munge_ctx_destroy(ctx)
+
+    return {
+        'STATUS': 'Success (0)',
+        'UID': _idname(uid.value, pwd.getpwuid),
+        'GID': _idname(gid.value, grp.getgrgid),
+        'LENGTH': str(length.value),
+        'MESSAGE': ''.join(message.splitlines()),
+    }
+
+
 def usage(program):
     """
     Help for test mode of munge helpers
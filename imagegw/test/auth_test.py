@@ -19,6 +19,7 @@
 import os
 import unittest
 from shifter_imagegw.auth import Authentication
+from shifter_imagegw import munge
 
 class AuthTestCase(unittest.TestCase):
 
@@ -36,10 +37,12 @@ class AuthTestCase(unittest.TestCase):
             "Platforms":{self.system: {"mungeSocketPath": "/tmp/munge.s"}}
         }
         self.auth = Authentication(self.config)
+        self.libmunge = munge.LIBMUNGE
 
     def tearDown(self):
         with open(self.test_dir + "munge.expired", 'w') as f:
             f.write('')
+        munge.LIBMUNGE = self.libmunge
 
     def test_auth(self):
         """ Test success """
@@ -57,6 +60,18 @@ class AuthTestCase(unittest.TestCase):
         with self.assertRaises(OSError) as cm:
             self.auth.authenticate("bad", self.system)
 
+    def test_auth_library(self):
+        """ Test selecting the libmunge decoder """
+        assert self.auth.unmunge is munge.unmunge
+        self.config['MungeLibrary'] = True
+        munge.LIBMUNGE = object()
+        auth = Authentication(self.config)
+        assert auth.unmunge is munge.unmunge_lib
+        # Fall back to unmunge if libmunge isn't available
+        munge.LIBMUNGE = None
+        auth = Authentication(self.config)
+        assert auth.unmunge is munge.unmunge
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -142,6 +142,15 @@ class GWTestCase(unittest.TestCase):
         uri='%s/list/%s/'%(self.url,self.system)
         rv = self.app.get(uri, headers={AUTH_HEADER:self.auth})
         assert rv.status_code==200
+        r=json.loads(rv.data)
+        assert 'list' in r
+        # Listing a system with a READY image
+        self.images.insert(self.good_record())
+        rv = self.app.get(uri, headers={AUTH_HEADER:self.auth})
+        assert rv.status_code==200
+        r=json.loads(rv.data)
+        ids=[rec['id'] for rec in r['list']]
+        assert 'bogus' in ids
 
     def test_pulllookup(self):
         # Do a pull so we can create an image record
@@ -62,6 +62,7 @@ class ImageMngrTestCase(unittest.TestCase):
         """
         tear down should stop the worker
         """
+        self.m.stop_state_updates()
         self.stop_worker()
 
     def start_worker(self,testmode=1,system='systema'):
@@ -92,6 +93,7 @@ class ImageMngrTestCase(unittest.TestCase):
         count=TIMEOUT/poll_interval
         state='UNKNOWN'
         while (state!=wstate and count>0):
+            self.m.update_states()
             state=self.m.get_state(id)
             count-=1
             time.sleep(poll_interval)
@@ -153,6 +155,21 @@ class ImageMngrTestCase(unittest.TestCase):
         except:
             pass
 
+    def test_session_cache(self):
+        self.m.session_cache_timeout=60
+        s1=self.m.new_session(self.auth,self.system)
+        s2=self.m.new_session(self.auth,self.system)
+        assert s1==s2
+        assert len(self.m.session_cache)==1
+        # Sessions are cached per system
+        s3=self.m.new_session(self.auth,'systemb')
+        assert s3['system']=='systemb'
+        assert len(self.m.session_cache)==2
+        # Failed authentications aren't cached
+        with self.assertRaises(OSError):
+            self.m.new_session(self.badauth,self.system)
+        assert len(self.m.session_cache)==2
+
     def test_noadmin(self):
         s=self.m.new_session(self.auth,self.system)
         assert s is not None
@@ -260,6 +277,24 @@ class ImageMngrTestCase(unittest.TestCase):
         assert rec is not None
         assert rec['tag'].count('testtag')==1
 
+    def test_0indexes(self):
+        indexes=self.images.index_information()
+        assert 'system_1_itype_1_tag_1' in indexes
+        assert 'status_1' in indexes
+
+    def test_0mongo_client(self):
+        from shifter_imagegw.imagemngr import ImageMngr, get_mongo_client
+        uri=self.config['MongoDBURI']
+        # Managers with the same settings share a client
+        m2=ImageMngr(self.config)
+        assert m2.images.database.client is self.m.images.database.client
+        client=get_mongo_client(uri,self.config.get('MongoDBOptions'))
+        assert client is self.m.images.database.client
+        # Different options get their own client
+        client2=get_mongo_client(uri,{'maxPoolSize':10})
+        assert client2 is not client
+        assert get_mongo_client(uri,{'maxPoolSize':10}) is client2
+
     def test_0isasystem(self):
         assert self.m._isasystem(self.system) is True
         assert self.m._isasystem('bogus') is False
@@ -346,6 +381,144 @@ class ImageMngrTestCase(unittest.TestCase):
         rec2=self.images.find_one({'_id':id2})
         assert rec2 is None
 
+    def test_0new_pull_record(self):
+        req={'system':self.system,'itype':self.itype,'pulltag':self.tag}
+        rec=self.m.new_pull_record(req,task_id='task1')
+        assert rec is not None
+        assert rec['status']=='ENQUEUED'
+        id=rec['_id']
+        # The record is reserved with its task in the same write
+        mrec=self.images.find_one({'_id':id})
+        assert mrec['task_id']=='task1'
+        assert mrec['task_type']=='pull'
+        assert 'last_pull' in mrec
+        assert self.m._pullable(mrec) is False
+        # Only one active pull record per image
+        assert self.m.new_pull_record(req) is None
+        # A failed pull record gets replaced in place
+        self.images.update({'_id':id},{'$set':{'status':'FAILURE','status_message':'bad'}})
+        current=self.images.find_one({'_id':id})
+        rec=self.m.new_pull_record(req,current)
+        assert rec['_id']==id
+        assert rec['status']=='ENQUEUED'
+        assert self.images.find(req).count()==1
+        assert 'status_message' not in self.images.find_one({'_id':id})
+        # But only if it didn't change since it was read
+        assert self.m.new_pull_record(req,current) is None
+        # A READY image doesn't hold the lock
+        self.images.update({'_id':id},{'$set':{'status':'READY'},'$unset':{'pull_lock':''}})
+        rec=self.m.new_pull_record(req)
+        assert rec['_id']!=id
+        assert self.images.find(req).count()==2
+
+    def test_0new_pull_record_locked(self):
+        # An EXPIRED record can't take the lock from another pull record
+        session=self.m.new_session(self.auth,self.system)
+        req={'system':self.system,'itype':self.itype,'pulltag':self.tag}
+        expired=self.good_pullrecord()
+        expired['status']='EXPIRED'
+        id=self.images.insert(expired)
+        pulling=self.good_pullrecord()
+        pulling['status']='ENQUEUED'
+        pulling['pull_lock']=self.m._pull_lock(req)
+        id2=self.images.insert(pulling)
+        current=self.images.find_one({'_id':id})
+        assert self.m.new_pull_record(req,current) is None
+        assert self.images.find_one({'_id':id})['status']=='EXPIRED'
+        # pull should return the record holding the lock
+        pr={'system':self.system,'itype':self.itype,'tag':self.tag}
+        rec=self.m.pull(session,pr)
+        assert rec['_id']==id2
+        assert rec['status']=='ENQUEUED'
+
+    def test_0pull_task_id(self):
+        # The task should be recorded with the state before it is queued
+        from shifter_imagegw import imagemngr
+        images=self.images
+        queued=[]
+        class FakeTask(object):
+            def apply_async(self,args,**kwargs):
+                mrec=images.find_one({'pulltag':args[0]['pulltag']})
+                queued.append((kwargs['task_id'],mrec))
+        dopull=imagemngr.dopull
+        imagemngr.dopull=FakeTask()
+        try:
+            session=self.m.new_session(self.auth,self.system)
+            pr={'system':self.system,'itype':self.itype,'tag':self.tag}
+            rec=self.m.pull(session,pr)
+        finally:
+            imagemngr.dopull=dopull
+        assert len(queued)==1
+        (task_id,mrec)=queued[0]
+        assert mrec['_id']==rec['_id']
+        assert mrec['status']=='ENQUEUED'
+        assert mrec['task_id']==task_id
+        assert mrec['task_type']=='pull'
+        assert 'last_pull' in mrec
+
+    def test_0pull_race(self):
+        # A second request between the reservation and the dispatch should
+        # get the reserved record instead of queueing another pull
+        from shifter_imagegw import imagemngr
+        session=self.m.new_session(self.auth,self.system)
+        pr={'system':self.system,'itype':self.itype,'tag':self.tag}
+        mgr=self.m
+        queued=[]
+        second=[]
+        class FakeResult(object):
+            state='PENDING'
+            info=None
+        class FakeTask(object):
+            def apply_async(self,args,**kwargs):
+                queued.append(kwargs['task_id'])
+                if len(second)==0:
+                    second.append(mgr.pull(session,pr))
+            def AsyncResult(self,task_id):
+                return FakeResult()
+        dopull=imagemngr.dopull
+        imagemngr.dopull=FakeTask()
+        try:
+            rec=self.m.pull(session,pr)
+        finally:
+            imagemngr.dopull=dopull
+        assert len(queued)==1
+        assert second[0]['_id']==rec['_id']
+        assert self.images.find({'pulltag':self.tag}).count()==1
+
+    def test_0pull_update_states(self):
+        # pull should only poll the tasks working on the requested image
+        from shifter_imagegw import imagemngr
+        polled=[]
+        class FakeResult(object):
+            state='STARTED'
+            info=None
+        class FakeTask(object):
+            def AsyncResult(self,task_id):
+                polled.append(task_id)
+                return FakeResult()
+        record=self.good_pullrecord()
+        record['status']='PULLING'
+        record['task_id']='mine'
+        record['task_type']='pull'
+        id=self.images.insert(record)
+        other=self.good_pullrecord()
+        other['pulltag']=self.tag2
+        other['status']='PULLING'
+        other['task_id']='other'
+        other['task_type']='pull'
+        self.images.insert(other)
+        dopull=imagemngr.dopull
+        imagemngr.dopull=FakeTask()
+        try:
+            session=self.m.new_session(self.auth,self.system)
+            pr={'system':self.system,'itype':self.itype,'tag':self.tag}
+            rec=self.m.pull(session,pr)
+        finally:
+            imagemngr.dopull=dopull
+        assert polled==['mine']
+        assert rec['_id']==id
+        assert rec['status']=='STARTED'
+
     def test_0update_states(self):
         # Test a repull
         record=self.good_record()
@@ -358,6 +531,20 @@ class ImageMngrTestCase(unittest.TestCase):
         rec=self.images.find_one({'_id':id})
         assert rec is None
 
+    def test_0state_updates(self):
+        # The manager shouldn't start polling on its own
+        assert self.m.timer is None
+        self.m.start_state_updates()
+        timer=self.m.timer
+        assert timer is not None
+        # Starting again keeps the running timer
+        self.m.start_state_updates()
+        assert self.m.timer is timer
+        self.m.stop_state_updates()
+        assert self.m.timer is None
+        timer.join(5)
+        assert self.m.timer is None
+
 
     def test_lookup(self):
         record=self.good_record()
@@ -377,6 +564,39 @@ class ImageMngrTestCase(unittest.TestCase):
         l=self.m.lookup(session,i)
         assert l==None
 
+    def test_lookup_cache(self):
+        record=self.good_record()
+        # Create a fake record in mongo
+        id=self.images.insert(record)
+        i=self.query.copy()
+        session=self.m.new_session(self.auth,self.system)
+        l=self.m.lookup(session,i)
+        assert l is not None
+        assert self.m._isready(i) is True
+        # A change made behind the manager's back is hidden by the cache
+        self.images.update({'_id':id},{'$set':{'ENTRY':'./cached'}})
+        l=self.m.lookup(session,i)
+        assert l['ENTRY']==''
+        # Updates through the manager invalidate the cache
+        self.m.update_mongo(id,{'entrypoint':'./new'})
+        l=self.m.lookup(session,i)
+        assert l['ENTRY']=='./new'
+        # Invalidating by system and tag only drops that tag
+        self.images.update({'_id':id},{'$set':{'ENTRY':'./cached'}})
+        self.m._cache_invalidate(system=self.system,tag=self.tag2)
+        l=self.m.lookup(session,i)
+        assert l['ENTRY']=='./new'
+        self.m._cache_invalidate(system=self.system,tag=self.tag)
+        l=self.m.lookup(session,i)
+        assert l['ENTRY']=='./cached'
+        self.m.update_mongo_state(id,'EXPIRED')
+        l=self.m.lookup(session,i)
+        assert l is None
+        assert self.m._isready(i) is False
+        # The references are dropped with the entries
+        assert self.m.lookup_cache=={}
+        assert self.m.lookup_cache_refs=={}
+
     def test_list(self):
         record=self.good_record()
         # Create a fake record in mongo
@@ -530,10 +750,13 @@ class ImageMngrTestCase(unittest.TestCase):
         q={'system':self.system,'itype':self.itype,'pulltag':self.tag}
         mrec=self.images.find_one(q)
         assert '_id' in mrec
+        assert 'task_id' in mrec
         # Track through transistions
         state=self.time_wait(id)
         #Debug
         assert state=='READY'
+        mrec=self.images.find_one({'_id':id})
+        assert 'task_id' not in mrec
         imagerec=self.m.lookup(session,pr)
         assert 'ENTRY' in imagerec
         assert 'ENV' in imagerec
@@ -543,6 +766,7 @@ class ImageMngrTestCase(unittest.TestCase):
         time.sleep(10)
         assert rec is not None
         id=rec['_id']
+        self.m.update_states()
         state=self.m.get_state(id)
         assert state=='FAILURE'
         self.stop_worker()
@@ -603,6 +827,7 @@ class ImageMngrTestCase(unittest.TestCase):
         rec=self.m.expire(session,er,testmode=1)#,delay=False)
         assert rec is not None
         time.sleep(2)
+        self.m.update_states()
         state=self.m.get_state(id)
         assert state=='EXPIRED'
         assert os.path.exists(file) is False
@@ -623,6 +848,7 @@ class ImageMngrTestCase(unittest.TestCase):
         rec=self.m.expire(session,er)#,delay=False)
         assert rec is not None
         time.sleep(2)
+        self.m.update_states()
         state=self.m.get_state(id)
         assert state=='EXPIRED'
         assert os.path.exists(file) is False
@@ -681,6 +907,7 @@ class ImageMngrTestCase(unittest.TestCase):
         session=self.m.new_session(self.authadmin,self.system)
         self.m.autoexpire(session,self.system,testmode=1)#,delay=False)
         time.sleep(2)
+        self.m.update_states()
         state=self.m.get_state(id)
         assert state=='EXPIRED'
         assert os.path.exists(file) is False
@@ -52,6 +52,13 @@ class ImageWorkerTestCase(unittest.TestCase):
     #  print "No teardown"
 
 
+    def test0_queue_config(self):
+        conf = self.imageworker.QUEUE.conf
+        assert conf.CELERY_ACKS_LATE is True
+        pulltimeout = self.config.get('PullUpdateTimeout', 300) * 10
+        timeout = conf.BROKER_TRANSPORT_OPTIONS['visibility_timeout']
+        assert timeout > pulltimeout
+
     def test0_pull_image(self):
         request = {'system':self.system, 'itype':self.itype, 'tag':self.tag}
         status = self.imageworker.pull_image(request)
@@ -17,9 +17,48 @@
 # See LICENSE for full text.
 
 import os
+import pwd
+import ctypes
 import unittest
 from shifter_imagegw import munge
 
+
+class FakeLibMunge(object):
+    """
+    Stand in for libmunge that returns a fixed error code from
+    munge_decode and tracks what was allocated and freed.
+    """
+    def __init__(self, ret, message='test'):
+        self.ret = ret
+        self.message = ctypes.create_string_buffer(message)
+        self.freed = 0
+        self.destroyed = 0
+        self.socket = None
+
+    def munge_ctx_create(self):
+        return 1
+
+    def munge_ctx_destroy(self, ctx):
+        self.destroyed += 1
+
+    def munge_ctx_set(self, ctx, opt, value):
+        self.socket = value.value
+        return munge.EMUNGE_SUCCESS
+
+    def munge_decode(self, encoded, ctx, buf, length, uid, gid):
+        if self.ret == munge.EMUNGE_SUCCESS:
+            buf._obj.value = ctypes.addressof(self.message)
+            length._obj.value = len(self.message.value)
+            uid._obj.value = os.getuid()
+            gid._obj.value = os.getgid()
+        return self.ret
+
+    def munge_strerror(self, ret):
+        return 'Error %d' % ret
+
+    def libc_free(self, buf):
+        self.freed += 1
+
 class MungeTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -30,10 +69,12 @@ class MungeTestCase(unittest.TestCase):
         self.expired = "expired"
         with open(self.test_dir + "munge.test", 'w') as f:
             f.write(self.encoded)
+        self.libmunge = munge.LIBMUNGE
 
     def tearDown(self):
         with open(self.test_dir + "munge.expired", 'w') as f:
             f.write('')
+        munge.LIBMUNGE = self.libmunge
 
     def test_munge(self):
         resp = munge.munge(self.message)
@@ -61,5 +102,39 @@ class MungeTestCase(unittest.TestCase):
         except OSError:
             assert True
 
+    def test_idname(self):
+        assert munge._idname(0, pwd.getpwuid) == 'root (0)'
+        def lookup(ident):
+            raise KeyError(ident)
+        assert munge._idname(12345, lookup) == '? (12345)'
+
+    def test_unmunge_lib(self):
+        munge.LIBMUNGE = FakeLibMunge(munge.EMUNGE_SUCCESS)
+        resp = munge.unmunge_lib(self.encoded, socket='/tmp/munge.s')
+        assert resp['STATUS'] == 'Success (0)'
+        assert resp['MESSAGE'] == self.message
+        assert resp['LENGTH'] == str(len(self.message))
+        uid = os.getuid()
+        assert resp['UID'] == munge._idname(uid, pwd.getpwuid)
+        assert munge.LIBMUNGE.socket == '/tmp/munge.s'
+        assert munge.LIBMUNGE.freed == 1
+        assert munge.LIBMUNGE.destroyed == 1
+
+    def test_unmunge_lib_errors(self):
+        for (ret, memo) in ((munge.EMUNGE_CRED_EXPIRED, 'Expired Credential'),
+                            (munge.EMUNGE_CRED_REPLAYED, 'Replayed Credential'),
+                            (1, 'Unknown munge error 1 None: Error 1')):
+            munge.LIBMUNGE = FakeLibMunge(ret)
+            with self.assertRaises(OSError) as cm:
+                munge.unmunge_lib(self.encoded)
+            assert str(cm.exception) == memo
+            assert munge.LIBMUNGE.freed == 0
+            assert munge.LIBMUNGE.destroyed == 1
+
+    def test_unmunge_lib_missing(self):
+        munge.LIBMUNGE = None
+        with self.assertRaises(OSError):
+            munge.unmunge_lib(self.encoded)
+
 if __name__ == '__main__':
     unittest.main()